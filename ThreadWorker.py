@@ -3,6 +3,7 @@
 # (from telecom operators) and build a comparison table for different operators
 
 import ntpath
+from concurrent.futures import ThreadPoolExecutor
 
 from PySide6 import QtCore
 
@@ -11,6 +12,14 @@ from models.DataRecognitionSystem import DataRecognitionSystem
 from models.Sheet import Sheet
 
 
+MAX_LOADING_THREADS = 8
+
+
+def _loadSheet(file):
+    sheet = Sheet(file)
+    return sheet, sheet.load()
+
+
 class CLRThreadWorker(QtCore.QThread):
     updateClrStatusSignal = QtCore.Signal(str)
     updateCLRTableWidgetSignal = QtCore.Signal(int)
@@ -46,20 +55,22 @@ class CLRThreadWorker(QtCore.QThread):
 
     def updateDataForUndefinedSheets(self, data):
         self._dataRecognitionSystem.setUserAliases(data)
-        changes = False
+        newlyDefinedSheets = []
+        stillUndefinedSheets = []
         for sheet in self._undefinedSheets:
             self._dataRecognitionSystem.determineSheetData(sheet)
             if sheet.isDataFormatDefined():
-                changes = True
                 self._clr.addSheet(sheet)
                 self.updateClrStatusSignal.emit(
                     f"Column definition succeeded for the sheet {sheet.filename}")
-                self._definedSheets.append(sheet)
-                self._undefinedSheets.remove(sheet)
+                newlyDefinedSheets.append(sheet)
             else:
                 self.updateClrStatusSignal.emit(
                     f"Coudn't define data in the sheet {sheet.filename}")
-        if changes:
+                stillUndefinedSheets.append(sheet)
+        self._definedSheets.extend(newlyDefinedSheets)
+        self._undefinedSheets = stillUndefinedSheets
+        if newlyDefinedSheets:
             self._clr.buildCLR()
             self.updateCLRTableWidgetSignal.emit(1)
             self._updateUndefinedSheetListUI()
@@ -69,20 +80,25 @@ class CLRThreadWorker(QtCore.QThread):
         self._undefinedSheets = []
         self.updateCLRTableWidgetSignal.emit(0)
         self._clr.removeAllSheets()
-        for file in self._selectedFiles:
-            self.updateClrStatusSignal.emit(f"Loading the file {ntpath.basename(file)}...")
-            sheet = Sheet(file)
-            if not sheet.load():
-                self.updateClrStatusSignal.emit(f"An error occurred while opening the file {ntpath.basename(file)}. This file may be corrupted or is not an excel file");
-                continue
-            self._dataRecognitionSystem.determineSheetData(sheet)
-            sheet.printInfo()
-            if not sheet.isDataFormatDefined():
-                print("Coudn't define data in the sheet ", sheet)
-                self._undefinedSheets.append(sheet)
-            else:
-                self._definedSheets.append(sheet)
-                self._clr.addSheet(sheet)
+        # files are loaded in parallel, sheets are recognized and added to CLR in this thread
+        loadingThreads = max(1, min(MAX_LOADING_THREADS, len(self._selectedFiles)))
+        with ThreadPoolExecutor(max_workers=loadingThreads) as executor:
+            loadingSheets = [(file, executor.submit(_loadSheet, file)) for file in self._selectedFiles]
+            for file, loadingSheet in loadingSheets:
+                filename = ntpath.basename(file)
+                self.updateClrStatusSignal.emit(f"Loading the file {filename}...")
+                sheet, loaded = loadingSheet.result()
+                if not loaded:
+                    self.updateClrStatusSignal.emit(f"An error occurred while opening the file {filename}. This file may be corrupted or is not an excel file");
+                    continue
+                self._dataRecognitionSystem.determineSheetData(sheet)
+                sheet.printInfo()
+                if not sheet.isDataFormatDefined():
+                    print("Coudn't define data in the sheet ", sheet)
+                    self._undefinedSheets.append(sheet)
+                else:
+                    self._definedSheets.append(sheet)
+                    self._clr.addSheet(sheet)
 
         self._updateUndefinedSheetListUI()
 
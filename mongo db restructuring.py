@@ -1,27 +1,42 @@
 # A program for multithreaded restructuring of a large database (MondoDB).
 # For all records that have certain fields, reformats these fields
 # (splits a full name into separate first and last names, etc.)
-import gc
-import math
+import re
 import sys
+import threading
 import time
+from collections import deque
 from multiprocessing import Pool
+from multiprocessing.util import Finalize
 
 import config
-from pymongo import UpdateOne
+from pymongo import MongoClient, UpdateOne
 from pymongo.errors import InvalidOperation, WTimeoutError, ExecutionTimeout, NetworkTimeout
 from utilities import logFromProcess, collectCollections
 
+try:
+    from pymongo.errors import ClientBulkWriteException
+except ImportError:  # pymongo<4.9, MongoClient.bulk_write не используется
+    class ClientBulkWriteException(Exception):
+        pass
+
 MB = 1048576
+# MongoClient.bulk_write (pymongo>=4.9, MongoDB>=8.0) пишет в несколько коллекций одной командой
+CLIENT_BULK_WRITE_SUPPORTED = hasattr(MongoClient, "bulk_write")
+CLIENT_BULK_WRITE_BATCH_SIZE = 10000
+# сколько блоков одновременно могут готовиться и сколько пакетов ждать отправки: ограничивает память главного процесса
+MAX_PENDING_BLOCKS = 2 * config.PROCESSES_POOL_SIZE
+FIO_UNSET_STAGE = {'$unset': config.FIO_KEY}  # одинаков для всех документов, создаётся один раз
+VK_ID_PATTERN = re.compile(r"\s*(\d+)(.*)", re.DOTALL)
 
 
 def extractName(record):
     try:
-        names = record[config.FIO_KEY]
-        names = names.strip().title().split()
-        lastName = names[0] if len(names) > 0 else ""
-        firstName = names[1] if len(names) > 1 else ""
-        patronymicName = names[2] if len(names) > 2 else ""
+        # split не дальше четвёртого слова: слова после отчества не используются
+        names = record[config.FIO_KEY].split(None, 3)
+        lastName = names[0].title() if len(names) > 0 else ""
+        firstName = names[1].title() if len(names) > 1 else ""
+        patronymicName = names[2].title() if len(names) > 2 else ""
     except BaseException:
         lastName = ""
         firstName = ""
@@ -30,13 +45,20 @@ def extractName(record):
     return firstName, lastName, patronymicName
 
 
-def processInitializer(processFunction, requestsFunction, actionName, operationsFunction, filter):
+def processInitializer(processFunction, requestsFunction, actionName, operationsFunction, filter, projection,
+                       clientBulkWrite):
     client = config.initializeMongoClient()
+    # клиент используется всеми задачами процесса (после close pymongo 4.x его не переоткрывает),
+    # поэтому закрывается один раз при завершении процесса
+    Finalize(None, client.close, exitpriority=10)
     processFunction.client = client
     processFunction.actionName = actionName
     processFunction.operationsFunction = operationsFunction
     processFunction.filter = filter
+    processFunction.projection = projection
+    processFunction.clientBulkWrite = clientBulkWrite
     requestsFunction.client = client
+    requestsFunction.clientBulkWrite = clientBulkWrite
 
 
 def prepareOperationsForChangingNamesVkIdTel(record):
@@ -48,7 +70,7 @@ def prepareOperationsForChangingNamesVkIdTel(record):
             config.PATRONYMIC_NAME_KEY: patronymicName
         }
         },
-        {'$unset': config.FIO_KEY}
+        FIO_UNSET_STAGE
     ]
     if config.VK_ID_KEY in record:
         operations.append(prepareOperationsForChangingVkId(record))
@@ -71,13 +93,19 @@ def prepareRequests(data):
     actionName = prepareRequests.actionName
     operationsFunc = prepareRequests.operationsFunction
     filter = prepareRequests.filter
-    db, collection, part, partsCount = data
+    projection = prepareRequests.projection
+    clientBulkWrite = prepareRequests.clientBulkWrite
+    db, collection, lo, hi, part, partsCount = data
+    namespace = "{}.{}".format(db, collection)
+
+    idRange = {"$gte": lo}
+    if hi is not None:
+        idRange["$lt"] = hi
 
     logFromProcess("Попытка получить данные ({}.{})".format(db, collection))
     try:
-        cursor = client[db][collection].find(filter) \
-            .skip(part * config.BULK_BATCH_SIZE) \
-            .limit(config.BULK_BATCH_SIZE)
+        cursor = client[db][collection].find({**filter, "_id": idRange}, projection) \
+            .batch_size(config.BULK_BATCH_SIZE)
         mongoData = list(cursor)
     except (WTimeoutError, ExecutionTimeout, NetworkTimeout) as e:
         logFromProcess("Возникла ошибка тайм-аут ({}.{}): {}\nПовтор операции через {} сек".format(db, collection, e,
@@ -93,78 +121,206 @@ def prepareRequests(data):
     for r in mongoData:
         operations = operationsFunc(r)
         if operations:
-            requests.append(UpdateOne({"_id": r['_id']}, operations))
+            if clientBulkWrite:
+                requests.append(UpdateOne({"_id": r['_id']}, operations, namespace=namespace))
+            else:
+                requests.append(UpdateOne({"_id": r['_id']}, operations))
 
-    client.close()
-    return requests, db, collection, len(mongoData)
+    return requests, namespace, len(mongoData)
 
 
 def makeBulkRequests(data):
     client = makeBulkRequests.client
-    requests, db, collection, recordsCount = data
-    collection = client[db][collection]
+    clientBulkWrite = makeBulkRequests.clientBulkWrite
+    requests, namespace, recordsCount = data
     if not requests:
         logFromProcess("Пустой массив запросов (нет документов для изменения)")
         return
     logFromProcess(
-        "Отправка запросов на сервер ({}.{}) (размер отправляемых данных: {:.5f} мб)".format(db, collection,
-                                                                                             sys.getsizeof(
-                                                                                                 requests) / MB))
+        "Отправка запросов на сервер ({}) (размер отправляемых данных: {:.5f} мб)".format(namespace,
+                                                                                          sys.getsizeof(
+                                                                                              requests) / MB))
     try:
-        result = collection.bulk_write(requests, ordered=False)
+        if clientBulkWrite:
+            result = client.bulk_write(requests, ordered=False)
+        else:
+            db, collection = namespace.split(".", 1)
+            result = client[db][collection].bulk_write(requests, ordered=False)
         logFromProcess(
-            "Успешно обновлены {} записей (из {}) ({}.{})".format(result.modified_count, recordsCount, db, collection))
+            "Успешно обновлены {} записей (из {}) ({})".format(result.modified_count, recordsCount, namespace))
+    except ClientBulkWriteException as e:
+        # MongoClient.bulk_write не выбрасывает тайм-ауты напрямую, а вкладывает их в ClientBulkWriteException
+        if isClientBulkWriteTimeout(e):
+            logFromProcess("Возникла ошибка тайм-аут ({}): {}\nПовтор операции через {} сек".format(
+                namespace, e, config.PROCESS_TIMEOUT_SLEEP_TIME))
+            time.sleep(config.PROCESS_TIMEOUT_SLEEP_TIME)
+            makeBulkRequests(data)
+            return
+        # запросы, не дошедшие до совпадения с документом: с ошибкой или не выполненные
+        matchedCount = e.partial_result.matched_count if e.partial_result is not None else 0
+        logFromProcess("Не были успешно обновлены {} записей (из {}) ({})\nОшибка: {}".format(
+            len(requests) - matchedCount, recordsCount, namespace, e))
     except InvalidOperation as e:
         logFromProcess("Не были успешно обновлены {} записей\nОшибка: {}".format(recordsCount, e))
     except (WTimeoutError, ExecutionTimeout, NetworkTimeout) as e:
-        logFromProcess("Возникла ошибка тайм-аут ({}.{}): {}\nПовтор операции через {} сек".format(db, collection, e,
-                                                                                                   config.PROCESS_TIMEOUT_SLEEP_TIME))
+        logFromProcess("Возникла ошибка тайм-аут ({}): {}\nПовтор операции через {} сек".format(namespace, e,
+                                                                                              config.PROCESS_TIMEOUT_SLEEP_TIME))
         time.sleep(config.PROCESS_TIMEOUT_SLEEP_TIME)
         makeBulkRequests(data)
-    finally:
-        client.close()
+
+
+def isClientBulkWriteTimeout(e):
+    if isinstance(e.error, (WTimeoutError, ExecutionTimeout, NetworkTimeout)):
+        return True
+    return any(error.get("errInfo", {}).get("wtimeout") for error in e.write_concern_errors or [])
 
 
 def extractVkIdAndOtherInformation(vkId):
     if type(vkId) == int:
         return vkId, ""
-    numbers = ""
-    otherInformation = ""
-    for pos, c in enumerate(vkId):
-        if c.isdigit():
-            numbers += c
-        else:
-            otherInformation = vkId[pos:]
+    match = VK_ID_PATTERN.match(vkId)
+    if match is None:
+        raise ValueError("Vk Id не начинается с цифр: {!r}".format(vkId))
+
+    return int(match.group(1)), match.group(2).strip()
+
+
+def computeIdBoundaries(client, db, collection, filter):
+    # границы блоков по _id вычисляются на сервере: каждая следующая - BULK_BATCH_SIZE-й _id после предыдущей,
+    # чтобы процессы выбирали данные диапазонами _id без skip по всей коллекции
+    mongoCollection = client[db][collection]
+    first = mongoCollection.find_one(filter, {"_id": 1}, sort=[("_id", 1)])
+    if first is None:
+        return [], 0
+    bounds = [first["_id"]]
+    while True:
+        nextBound = list(mongoCollection.find({**filter, "_id": {"$gt": bounds[-1]}}, {"_id": 1})
+                         .sort("_id", 1)
+                         .skip(config.BULK_BATCH_SIZE - 1)
+                         .limit(1))
+        if not nextBound:
             break
+        bounds.append(nextBound[0]["_id"])
+    # во всех блоках, кроме последнего, ровно BULK_BATCH_SIZE документов, так что отдельный count_documents
+    # по всей коллекции не нужен
+    lastBlockCount = mongoCollection.count_documents({**filter, "_id": {"$gte": bounds[-1]}})
+    documentsCount = (len(bounds) - 1) * config.BULK_BATCH_SIZE + lastBlockCount
+    # у последнего блока hi = None (без верхней границы)
+    return list(zip(bounds, bounds[1:] + [None])), documentsCount
+
+
+def collectThreadData(client, db, collection, filter):
+    print("Начало работы с коллекцией {}.{}".format(db, collection))
+    print("Подсчёт количества докуметов для изменения и вычисление границ блоков по _id: ", end='')
+    boundaries, documentsCount = computeIdBoundaries(client, db, collection, filter)
+    print("найдено {} записей для изменения".format(documentsCount))
+
+    if (documentsCount == 0):
+        return []
+    count = len(boundaries)
+    return [(db, collection, lo, hi, i, count) for i, (lo, hi) in enumerate(boundaries)]
+
+
+def mergeRequests(preparedRequests):
+    # объединение подготовленных блоков разных коллекций в крупные пакеты для MongoClient.bulk_write
+    requests, namespaces, recordsCount = [], set(), 0
+    for blockRequests, namespace, blockRecordsCount in preparedRequests:
+        requests.extend(blockRequests)
+        namespaces.add(namespace)
+        recordsCount += blockRecordsCount
+        if len(requests) >= CLIENT_BULK_WRITE_BATCH_SIZE:
+            yield requests, ", ".join(sorted(namespaces)), recordsCount
+            requests, namespaces, recordsCount = [], set(), 0
+    if requests:
+        yield requests, ", ".join(sorted(namespaces)), recordsCount
+
+
+def runRequestsPipeline(threadData, initArgs, merge):
+    # подготовка и отправка запросов в разных пулах: отправка блока начинается сразу после его подготовки
+    preparingSlots = threading.Semaphore(MAX_PENDING_BLOCKS)
+    stopped = threading.Event()
+
+    def throttledThreadData():  # читается потоком пула: новый блок выдаётся, когда главный процесс забрал готовый
+        for data in threadData:
+            preparingSlots.acquire()
+            if stopped.is_set():
+                return
+            yield data
+
+    def receivedRequests(preparedRequests):
+        for requests in preparedRequests:
+            preparingSlots.release()
+            yield requests
+
+    with Pool(config.PROCESSES_POOL_SIZE, processInitializer, initArgs) as preparePool, \
+            Pool(config.PROCESSES_POOL_SIZE, processInitializer, initArgs) as writePool:
+        try:
+            print("Подготовка и отправка запросов")
+            preparedRequests = receivedRequests(
+                preparePool.imap_unordered(prepareRequests, throttledThreadData(), chunksize=1))
+            if merge:
+                preparedRequests = mergeRequests(preparedRequests)
+            pendingWrites = deque()
+            for requests in preparedRequests:
+                # пока отправка не успевает, новые блоки не забираются и подготовка останавливается
+                if len(pendingWrites) >= MAX_PENDING_BLOCKS:
+                    pendingWrites.popleft().get()
+                pendingWrites.append(writePool.apply_async(makeBulkRequests, (requests,)))
+            for result in pendingWrites:
+                result.get()
+        finally:
+            # при ошибке поток пула не должен остаться заблокированным в throttledThreadData
+            stopped.set()
+            preparingSlots.release()
+        # штатное завершение процессов, чтобы клиенты закрылись (выход из with вызывает terminate)
+        preparePool.close()
+        writePool.close()
+        preparePool.join()
+        writePool.join()
+
+
+def isClientBulkWriteAvailable(client):
+    return CLIENT_BULK_WRITE_SUPPORTED and client.server_info()["versionArray"][0] >= 8
+
+
+def processCollectionsWithClientBulkWrite(client, collections, filter, projection, operationsFunction, operationName):
+    timeForCollections = time.time()
+    threadData = []
+    for db, collection in collections:
+        threadData.extend(collectThreadData(client, db, collection, filter))
+
+    if not threadData:
+        return
+
+    print("Запуск потоков")
+    runRequestsPipeline(threadData,
+                        (prepareRequests, makeBulkRequests, operationName, operationsFunction, filter, projection,
+                         True),
+                        merge=True)
 
-    return int(numbers), otherInformation.strip()
+    print("Работа над коллекциями заняла {:2f} сек".format(time.time() - timeForCollections))
 
 
-def processCollections(client, collections, filter, operationsFunction, operationName):
+def processCollections(client, collections, filter, projection, operationsFunction, operationName):
+    if isClientBulkWriteAvailable(client):
+        processCollectionsWithClientBulkWrite(client, collections, filter, projection, operationsFunction,
+                                              operationName)
+        return
+
     for db, collection in collections:
         timeForCollection = time.time()
-        threadData = []
-        print("Начало работы с коллекцией {}.{}".format(db, collection))
-        print("Подсчёт количества докуметов для изменения: ", end='')
-        documentsCount = client[db][collection].count_documents(filter)
-        print("найдено {} записей для изменения".format(documentsCount))
+        threadData = collectThreadData(client, db, collection, filter)
 
-        if (documentsCount == 0):
+        if not threadData:
             continue
-        count = math.ceil(documentsCount / config.BULK_BATCH_SIZE)
-        threadData.extend((db, collection, i, count) for i in range(count))
 
         print("Запуск потоков")
-
-        with Pool(config.PROCESSES_POOL_SIZE, processInitializer,
-                  (prepareRequests, makeBulkRequests, operationName, operationsFunction, filter)) as pool:
-            print("Подготовка запросов для обновление записей")
-            requests = pool.map(prepareRequests, threadData)
-            print("Отправка запросов")
-            pool.map(makeBulkRequests, requests)
+        runRequestsPipeline(threadData,
+                            (prepareRequests, makeBulkRequests, operationName, operationsFunction, filter,
+                             projection, False),
+                            merge=False)
 
         print("Работа над коллекцией {}.{} заняла {:2f} сек".format(db, collection, time.time() - timeForCollection))
-        gc.collect()
 
 
 if __name__ == '__main__':
@@ -181,12 +337,15 @@ if __name__ == '__main__':
     # часть 1
     print("Поиск и изменение записей для изменения ФИО и Vk ID (если присутствует)")
     filter = {config.FIO_KEY: {"$exists": True}}
-    processCollections(client, collections, filter, prepareOperationsForChangingNamesVkIdTel, "изменение ФИО, Vk Id ")
+    projection = {"_id": 1, config.FIO_KEY: 1, config.VK_ID_KEY: 1}
+    processCollections(client, collections, filter, projection, prepareOperationsForChangingNamesVkIdTel,
+                       "изменение ФИО, Vk Id ")
 
     # часть 2: поиск и изменение только записей в которых всё ещё поле Vk неформатировано
     print("Поиск и изменение записей для изменения Vk ID")
     filter = {config.VK_ID_KEY: {"$exists": True},
               config.OTHER_INFORMATION_KEY: {"$exists": False}}
-    processCollections(client, collections, filter, prepareOperationsForChangingVkId, "изменение Vk Id")
+    projection = {"_id": 1, config.VK_ID_KEY: 1}
+    processCollections(client, collections, filter, projection, prepareOperationsForChangingVkId, "изменение Vk Id")
 
     print("Программа работала ", time.time() - startTime, " секунд")
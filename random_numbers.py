@@ -2,9 +2,11 @@
 # when the player moves
 # Used by a player who was running 10 games simultaneously on his desktop
 
+import ctypes
 import random
 import threading
 import time
+from ctypes import wintypes
 from tkinter import *
 
 import mouse as m
@@ -15,13 +17,34 @@ from mss import ScreenShotError
 KEY_PIXEL_COORD = (444, 559)
 KEY_PIXEL1 = (140, 18, 15)
 KEY_PIXEL2 = (140, 18, 15)
+# key pixels packed the way 3 BGRA bytes of the raw screenshot are read as a little-endian int
+KEY_PIXEL1_U32 = KEY_PIXEL1[0] << 16 | KEY_PIXEL1[1] << 8 | KEY_PIXEL1[2]
+KEY_PIXEL2_U32 = KEY_PIXEL2[0] << 16 | KEY_PIXEL2[1] << 8 | KEY_PIXEL2[2]
 DEBUG_KEY_PIXEL = False
 OFFSET_X = 30
 OFFSET_Y = 30
+SCREEN_CAPTURE_INTERVAL = 0.1
+SCREEN_CAPTURE_TIMEOUT = 5  # seconds, older screenshots are not used
+MONITORS_REFRESH_INTERVAL = 10  # seconds, monitors geometry is re-read to follow resolution and monitor changes
+CHECK_INTERVAL_MS = 100
+MAX_IDLE_CHECK_INTERVAL_MS = 2000  # checks of a minimized window or while waiting for the player's turn back off to this
+# Win32 window events, new game windows are reported by the system instead of polling the window list
+EVENT_OBJECT_SHOW = 0x8002
+EVENT_OBJECT_NAMECHANGE = 0x800C
+WINEVENT_OUTOFCONTEXT = 0x0000
+WINEVENT_SKIPOWNPROCESS = 0x0002  # skip the reminders' own Tk windows
+GA_ROOT = 2
+OBJID_WINDOW = 0
+CHILDID_SELF = 0
+NUMBER_COLORS = tuple('red' if n <= 33 else 'light green' if n <= 66 else 'white' for n in range(101))
+
+
+def isGameTitle(title: str):
+    return title.startswith("Game")
 
 
 def windowTitleFilter(x: gw.Win32Window):  # function for window title filtering
-    return x.title.startswith("Game")
+    return isGameTitle(x.title)
 
 
 def find_mouse():
@@ -30,20 +53,59 @@ def find_mouse():
 
 def generate_random_and_color():
     number = random.randint(0, 100)
-    color = 'white'
-    if number <= 33:
-        color = 'red'
-    elif 33 <= number <= 66:
-        color = 'light green'
-    elif 66 <= number:
-        color = 'white'
-    return number, color
+    return number, NUMBER_COLORS[number]
+
+
+class ScreenCache(threading.Thread):  # the only thread that captures the screen, shared by all reminders
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._screen = None
+        self._capturedAt = 0
+
+    def run(self):
+        failing = False
+        while True:
+            # mss caches monitors geometry, so the instance is recreated periodically and after a failed grab
+            try:
+                with mss.mss() as sct:  # mss instance is not thread-safe, so it lives in this thread only
+                    refreshAt = time.monotonic() + MONITORS_REFRESH_INTERVAL
+                    while time.monotonic() < refreshAt:
+                        screen = sct.grab(sct.monitors[0])  # virtual screen with all monitors
+                        with self._lock:
+                            self._screen = screen
+                            self._capturedAt = time.monotonic()
+                        self._ready.set()
+                        failing = False
+                        time.sleep(SCREEN_CAPTURE_INTERVAL)
+            except ScreenShotError as e:
+                if not failing:  # only the first failure in a row is reported
+                    print("Screen capture failed:", e)
+                failing = True
+                time.sleep(SCREEN_CAPTURE_INTERVAL)
+
+    def get_pixel_u32(self, x, y):  # x, y - absolute screen coordinates, returns 0xRRGGBB
+        if not self._ready.wait(timeout=SCREEN_CAPTURE_TIMEOUT):
+            raise ScreenShotError("No screenshot was captured.")
+        with self._lock:
+            screen = self._screen
+            capturedAt = self._capturedAt
+        if time.monotonic() - capturedAt > SCREEN_CAPTURE_TIMEOUT:
+            raise ScreenShotError("The last screenshot is too old, screen capture is failing.")
+        x -= screen.left
+        y -= screen.top
+        if not (0 <= x < screen.width and 0 <= y < screen.height):
+            raise ScreenShotError("Pixel location out of range.")
+        offset = (y * screen.width + x) * 4
+        return int.from_bytes(screen.raw[offset:offset + 3], 'little')
 
 
 class Reminder(object):
     def __init__(self, window: gw.Win32Window):
         self.window = window
         self._turn = False
+        self._idleTicks = 0
         self.root = Tk()
         self._label = None
         self.root.overrideredirect(True)  # remove title
@@ -57,12 +119,13 @@ class Reminder(object):
 
     def checkWindow(self):
         if self.window.isMinimized:
-            self.root.after(100, self.sleep)
+            self._scheduleCheck(idle=True)
             self.root.withdraw()
             return
 
         try:
-            if main_players_turn(self.window):
+            turn = main_players_turn(self.window)
+            if turn:
                 if not self._turn:
                     self._turn = True
                     self._generateNumber()
@@ -74,7 +137,7 @@ class Reminder(object):
                     self._turn = False
                     self.root.withdraw()
                     self._label.grid_forget()
-            self.root.after(100, self.sleep)  # Schedule self.hide in show_int seconds
+            self._scheduleCheck(idle=not turn)
         except (ScreenShotError, gw.PyGetWindowException):
             print("Completing window tracking")
             self.root.destroy()
@@ -82,6 +145,15 @@ class Reminder(object):
     def start(self):
         self.root.mainloop()
 
+    def _scheduleCheck(self, idle):  # exponential backoff while idle, reset on the player's turn
+        if idle:
+            self._idleTicks += 1
+            delay = min(MAX_IDLE_CHECK_INTERVAL_MS, CHECK_INTERVAL_MS * (1 << min(self._idleTicks, 5)))
+        else:
+            self._idleTicks = 0
+            delay = CHECK_INTERVAL_MS
+        self.root.after(delay, self.sleep)
+
     def _generateNumber(self):
         number_and_color = generate_random_and_color()
         self._label = Label(self.root, text=str(number_and_color[0]),
@@ -89,24 +161,14 @@ class Reminder(object):
         self._label.grid(column=0, row=0)
 
     def checkWndExist(self):
-        w = self.window
-        for i in gw.getAllWindows():
-            if i._hWnd == w._hWnd:
-                return True
-        return False
-
-
-def take_quick_screen_shot(w: gw.Win32Window):
-    monitor = {"top": w.box.top, "left": w.box.left, "width": w.box.width, "height": w.box.height}
-    return sct.grab(monitor)
+        return user32.IsWindow(self.window._hWnd) != 0
 
 
 def main_players_turn(w: gw.Win32Window):
-    screen = take_quick_screen_shot(w)
-    p = screen.pixel(KEY_PIXEL_COORD[0], KEY_PIXEL_COORD[1])
+    p = screen_cache.get_pixel_u32(w.box.left + KEY_PIXEL_COORD[0], w.box.top + KEY_PIXEL_COORD[1])
     if DEBUG_KEY_PIXEL:
-        print(p)
-    return p == KEY_PIXEL1 or p == KEY_PIXEL2
+        print(p >> 16, p >> 8 & 0xFF, p & 0xFF)
+    return p == KEY_PIXEL1_U32 or p == KEY_PIXEL2_U32
 
 
 def createThread(w):
@@ -114,20 +176,69 @@ def createThread(w):
     r.start()
 
 
+user32 = ctypes.windll.user32
+user32.SetWinEventHook.restype = wintypes.HANDLE
+user32.UnhookWinEvent.argtypes = (wintypes.HANDLE,)
+user32.GetAncestor.argtypes = (wintypes.HWND, wintypes.UINT)
+user32.GetAncestor.restype = wintypes.HWND
+user32.GetWindowTextLengthW.argtypes = (wintypes.HWND,)
+user32.GetWindowTextW.argtypes = (wintypes.HWND, wintypes.LPWSTR, ctypes.c_int)
+WinEventProcType = ctypes.WINFUNCTYPE(None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND, wintypes.LONG,
+                                      wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+handledWindows = set()  # hWnd of windows that already have a reminder
+
+
+def handleWindow(w: gw.Win32Window):
+    if w._hWnd in handledWindows or not windowTitleFilter(w):
+        return
+    my_thread = threading.Thread(target=createThread, args=(w,))
+    my_thread.start()
+    handledWindows.add(w._hWnd)
+    print("Добавлено окно ")
+
+
+@WinEventProcType
+def onWindowEvent(hWinEventHook, event, hwnd, idObject, idChild, idEventThread, eventTime):
+    if not hwnd or idObject != OBJID_WINDOW or idChild != CHILDID_SELF:
+        return
+    if hwnd in handledWindows or user32.GetAncestor(hwnd, GA_ROOT) != hwnd:  # skip child controls too
+        return
+    # events come for every window on the desktop, so the title is checked before creating Win32Window
+    length = user32.GetWindowTextLengthW(hwnd)
+    title = ctypes.create_unicode_buffer(length + 1)
+    user32.GetWindowTextW(hwnd, title, length + 1)
+    if not isGameTitle(title.value):
+        return
+    try:
+        handleWindow(gw.Win32Window(hwnd))
+    except gw.PyGetWindowException:  # the window was closed before the event was handled
+        return
+
+
 def main():
-    handledWindows = []
-    while True:
-        windows = list(filter(windowTitleFilter, gw.getAllWindows()))
-        for w in windows:
-            if w not in handledWindows:
-                my_thread = threading.Thread(target=createThread, args=(w,))
-                my_thread.start()
-                handledWindows.append(w)
-                print("Добавлено окно ")
-        time.sleep(1)
+    for w in gw.getAllWindows():  # windows opened before the start
+        handleWindow(w)
+
+    # a title can be set after the window is shown, so name changes are tracked too
+    hooks = []
+    try:
+        for event in (EVENT_OBJECT_SHOW, EVENT_OBJECT_NAMECHANGE):
+            hook = user32.SetWinEventHook(event, event, 0, onWindowEvent, 0, 0,
+                                          WINEVENT_OUTOFCONTEXT | WINEVENT_SKIPOWNPROCESS)
+            if not hook:
+                raise OSError(f"SetWinEventHook failed for event {event:#x}, new windows can't be tracked")
+            hooks.append(hook)
+        msg = wintypes.MSG()
+        while user32.GetMessageW(ctypes.byref(msg), 0, 0, 0) > 0:  # out-of-context hooks are called from here
+            user32.TranslateMessage(ctypes.byref(msg))
+            user32.DispatchMessageW(ctypes.byref(msg))
+    finally:
+        for hook in hooks:
+            user32.UnhookWinEvent(hook)
 
 
 if __name__ == '__main__':
-    with mss.mss() as sct:
-        print("Starting...")
-        main()
+    screen_cache = ScreenCache()
+    screen_cache.start()
+    print("Starting...")
+    main()